@@ -3,6 +3,7 @@ import json
 import os
 import logging
 import uuid
+import aiohttp
 from dotenv import load_dotenv
 
 from quart import (
@@ -19,11 +20,12 @@ from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from backend.auth.auth_utils import get_authenticated_user_details
 from backend.history.cosmosdbservice import CosmosConversationClient
 
-from backend.utils import format_as_ndjson, format_stream_response, generateFilterString, parse_multi_columns, format_non_streaming_response
+from backend.utils import format_as_ndjson, format_stream_response, generateFilterString, parse_multi_columns, format_non_streaming_response, init_logging, close_graph_client
 
 bp = Blueprint("routes", __name__, static_folder='static')
 
 def create_app():
+    init_logging()
     app = Quart(__name__)
     app.register_blueprint(bp)
     return app
@@ -43,11 +45,6 @@ async def assets(path):
 
 load_dotenv()
 
-# Debug settings
-DEBUG = os.environ.get("DEBUG", "false")
-if DEBUG.lower() == "true":
-    logging.basicConfig(level=logging.DEBUG)
-
 USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 
 # On Your Data Settings
@@ -250,8 +247,15 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
         raise e
 
 
+# CosmosDB client shared by all requests handled by this worker
+cosmos_conversation_client = None
+cosmos_session = None
+
 def init_cosmosdb_client():
-    cosmos_conversation_client = None
+    global cosmos_conversation_client, cosmos_session
+    if cosmos_conversation_client:
+        return cosmos_conversation_client
+
     if CHAT_HISTORY_ENABLED:
         try:
             cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
@@ -261,12 +265,16 @@ def init_cosmosdb_client():
             else:
                 credential = AZURE_COSMOSDB_ACCOUNT_KEY
 
+            if not cosmos_session or cosmos_session.closed:
+                cosmos_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60))
+
             cosmos_conversation_client = CosmosConversationClient(
                 cosmosdb_endpoint=cosmos_endpoint, 
                 credential=credential, 
                 database_name=AZURE_COSMOSDB_DATABASE,
                 container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
-                enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK
+                enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK,
+                session=cosmos_session
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
@@ -278,7 +286,32 @@ def init_cosmosdb_client():
     return cosmos_conversation_client
 
 
-def get_configured_data_source():
+@bp.before_app_serving
+async def warm_cosmosdb_client():
+    ## create the shared client and read the database and container metadata before taking traffic
+    if not CHAT_HISTORY_ENABLED:
+        return
+    try:
+        success, err = await init_cosmosdb_client().ensure()
+        if not success:
+            logging.warning(f"CosmosDB warm-up failed: {err}")
+    except Exception:
+        logging.exception("Exception in CosmosDB warm-up")
+
+
+@bp.after_app_serving
+async def close_clients():
+    global cosmos_conversation_client, cosmos_session
+    if cosmos_conversation_client:
+        await cosmos_conversation_client.cosmosdb_client.close()
+        cosmos_conversation_client = None
+    if cosmos_session:
+        await cosmos_session.close()
+        cosmos_session = None
+    await close_graph_client()
+
+
+async def get_configured_data_source():
     data_source = {}
     query_type = "simple"
     if DATASOURCE_TYPE == "AzureCognitiveSearch":
@@ -295,7 +328,7 @@ def get_configured_data_source():
             userToken = request.headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN', "")
             logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
 
-            filter = generateFilterString(userToken)
+            filter = await generateFilterString(userToken)
             logging.debug(f"FILTER: {filter}")
         
         # Set authentication
@@ -468,7 +501,7 @@ def get_configured_data_source():
 
     return data_source
 
-def prepare_model_args(request_body):
+async def prepare_model_args(request_body):
     request_messages = request_body.get("messages", [])
     messages = []
     if not SHOULD_USE_DATA:
@@ -498,31 +531,33 @@ def prepare_model_args(request_body):
 
     if SHOULD_USE_DATA:
         model_args["extra_body"] = {
-            "dataSources": [get_configured_data_source()]
+            "dataSources": [await get_configured_data_source()]
         }
 
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = ["key", "connectionString", "embeddingKey", "encodedApiKey", "apiKey"]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["dataSources"][0]["parameters"].get(secret_param):
-                model_args_clean["extra_body"]["dataSources"][0]["parameters"][secret_param] = "*****"
-        authentication = model_args_clean["extra_body"]["dataSources"][0]["parameters"].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["dataSources"][0]["parameters"]["authentication"][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["dataSources"][0]["parameters"].get("embeddingDependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
+    # Redacting and dumping the request body is only worth doing when it will be logged
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        model_args_clean = copy.deepcopy(model_args)
+        if model_args_clean.get("extra_body"):
+            secret_params = ["key", "connectionString", "embeddingKey", "encodedApiKey", "apiKey"]
+            for secret_param in secret_params:
+                if model_args_clean["extra_body"]["dataSources"][0]["parameters"].get(secret_param):
+                    model_args_clean["extra_body"]["dataSources"][0]["parameters"][secret_param] = "*****"
+            authentication = model_args_clean["extra_body"]["dataSources"][0]["parameters"].get("authentication", {})
+            for field in authentication:
                 if field in secret_params:
-                    model_args_clean["extra_body"]["dataSources"][0]["parameters"]["embeddingDependency"]["authentication"][field] = "*****"
+                    model_args_clean["extra_body"]["dataSources"][0]["parameters"]["authentication"][field] = "*****"
+            embeddingDependency = model_args_clean["extra_body"]["dataSources"][0]["parameters"].get("embeddingDependency", {})
+            if "authentication" in embeddingDependency:
+                for field in embeddingDependency["authentication"]:
+                    if field in secret_params:
+                        model_args_clean["extra_body"]["dataSources"][0]["parameters"]["embeddingDependency"]["authentication"][field] = "*****"
         
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
+        logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
     
     return model_args
 
 async def send_chat_request(request):
-    model_args = prepare_model_args(request)
+    model_args = await prepare_model_args(request)
 
     try:
         azure_openai_client = init_openai_client()
@@ -628,8 +663,6 @@ async def add_conversation():
         else:
             raise Exception("No user message found")
         
-        await cosmos_conversation_client.cosmosdb_client.close()
-        
         # Submit request to Chat Completions for response
         request_body = await request.get_json()
         history_metadata['conversation_id'] = conversation_id
@@ -683,7 +716,6 @@ async def update_conversation():
             raise Exception("No bot messages found")
         
         # Submit request to Chat Completions for response
-        await cosmos_conversation_client.cosmosdb_client.close()
         response = {'success': True}
         return jsonify(response), 200
        
@@ -745,8 +777,6 @@ async def delete_conversation():
         ## Now delete the conversation 
         deleted_conversation = await cosmos_conversation_client.delete_conversation(user_id, conversation_id)
 
-        await cosmos_conversation_client.cosmosdb_client.close()
-
         return jsonify({"message": "Successfully deleted conversation and messages", "conversation_id": conversation_id}), 200
     except Exception as e:
         logging.exception("Exception in /history/delete")
@@ -766,7 +796,6 @@ async def list_conversations():
 
     ## get the conversations from cosmos
     conversations = await cosmos_conversation_client.get_conversations(user_id, offset=offset, limit=25)
-    await cosmos_conversation_client.cosmosdb_client.close()
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
@@ -804,7 +833,6 @@ async def get_conversation():
     ## format the messages in the bot frontend format
     messages = [{'id': msg['id'], 'role': msg['role'], 'content': msg['content'], 'createdAt': msg['createdAt'], 'feedback': msg.get('feedback')} for msg in conversation_messages]
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
 
 @bp.route("/history/rename", methods=["POST"])
@@ -836,7 +864,6 @@ async def rename_conversation():
     conversation['title'] = title
     updated_conversation = await cosmos_conversation_client.upsert_conversation(conversation)
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify(updated_conversation), 200
 
 @bp.route("/history/delete_all", methods=["DELETE"])
@@ -863,7 +890,6 @@ async def delete_all_conversations():
 
             ## Now delete the conversation 
             deleted_conversation = await cosmos_conversation_client.delete_conversation(user_id, conversation['id'])
-        await cosmos_conversation_client.cosmosdb_client.close()
         return jsonify({"message": f"Successfully deleted conversation and messages for user {user_id}"}), 200
     
     except Exception as e:
@@ -911,7 +937,6 @@ async def ensure_cosmos():
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
         
-        await cosmos_conversation_client.cosmosdb_client.close()
         return jsonify({"message": "CosmosDB is configured and working"}), 200
     except Exception as e:
         logging.exception("Exception in /history/ensure")
@@ -1,18 +1,34 @@
 import uuid
+import asyncio
+import aiohttp
 from datetime import datetime
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
+
+## Cosmos DB limits a transactional batch to 100 operations
+MAX_BATCH_OPERATIONS = 100
+## cap on in-flight requests when falling back to individual deletes
+MAX_CONCURRENT_DELETES = 32
   
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, session: aiohttp.ClientSession = None):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        client_options = {
+            'retry_total': 9,
+            'retry_backoff_max': 30,
+            'connection_timeout': 5
+        }
+        if session:
+            ## share the caller's connection pool instead of opening a new one per client
+            client_options['transport'] = AioHttpTransport(session=session, session_owner=False)
         try:
-            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential, **client_options)
         except exceptions.CosmosHttpResponseError as e:
             if e.status_code == 401:
                 raise ValueError("Invalid credentials") from e
@@ -47,11 +63,12 @@ class CosmosConversationClient():
         return True, "CosmosDB client initialized successfully"
 
     async def create_conversation(self, user_id, title = ''):
+        now = datetime.utcnow().isoformat()
         conversation = {
             'id': str(uuid.uuid4()),  
             'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
+            'createdAt': now,  
+            'updatedAt': now,  
             'userId': user_id,
             'title': title
         }
@@ -83,11 +100,33 @@ class CosmosConversationClient():
         messages = await self.get_messages(user_id, conversation_id)
         response_list = []
         if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
+            ## all messages share the userId partition key, so delete them in transactional batches
+            for i in range(0, len(messages), MAX_BATCH_OPERATIONS):
+                chunk = messages[i:i + MAX_BATCH_OPERATIONS]
+                batch_operations = [("delete", (message['id'],)) for message in chunk]
+                try:
+                    resp = await self.container_client.execute_item_batch(batch_operations=batch_operations, partition_key=user_id)
+                    response_list.append(resp)
+                except exceptions.CosmosBatchOperationError:
+                    ## the batch is rolled back if any delete fails, so fall back to concurrent individual deletes
+                    response_list.extend(await self.delete_items(chunk, user_id))
             return response_list
 
+    async def delete_items(self, items, user_id):
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DELETES)
+
+        async def delete_item(item):
+            async with semaphore:
+                return await self.container_client.delete_item(item=item['id'], partition_key=user_id)
+
+        results = await asyncio.gather(*(delete_item(item) for item in items), return_exceptions=True)
+        ## a message that is already gone is the expected reason for a failed batch; anything else must
+        ## fail the whole delete so callers don't remove the conversation and orphan its messages
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, exceptions.CosmosResourceNotFoundError):
+                raise result
+        return [result for result in results if not isinstance(result, BaseException)]
+
 
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
         parameters = [
@@ -96,45 +135,32 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        query = f"SELECT c.id, c.title, c.createdAt, c.updatedAt FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
         if limit is not None:
             query += f" offset {offset} limit {limit}" 
         
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
-        
-        return conversations
+        return [item async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, max_item_count=-1)]
 
     async def get_conversation(self, user_id, conversation_id):
-        parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
-            {
-                'name': '@userId',
-                'value': user_id
-            }
-        ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        ## id and userId (the partition key) identify the document, so a point read is enough
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
 
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
+        ## if the id belongs to something other than a conversation, return None
+        if conversation.get('type') != 'conversation':
             return None
-        else:
-            return conversations[0]
+        return conversation
  
     async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        now = datetime.utcnow().isoformat()
         message = {
             'id': uuid,
             'type': 'message',
             'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
+            'createdAt': now,
+            'updatedAt': now,
             'conversationId' : conversation_id,
             'role': input_message['role'],
             'content': input_message['content']
@@ -143,24 +169,28 @@ class CosmosConversationClient():
         if self.enable_message_feedback:
             message['feedback'] = ''
         
-        resp = await self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
-                return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
+        ## callers only need the message we wrote, so skip sending the written documents back
+        await self.container_client.upsert_item(message, no_response=True)
+        ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
+        try:
+            await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/updatedAt', 'value': message['createdAt']}],
+                ## only patch conversations, not another document that happens to share the id
+                filter_predicate="FROM c WHERE c.type = 'conversation'",
+                no_response=True
+            )
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            return "Conversation not found"
+        return message
     
     async def update_message_feedback(self, user_id, message_id, feedback):
         message = await self.container_client.read_item(item=message_id, partition_key=user_id)
         if message:
             message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
-            return resp
+            await self.container_client.upsert_item(message, no_response=True)
+            return message
         else:
             return False
 
@@ -175,10 +205,6 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
-        messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            messages.append(item)
-
-        return messages
+        query = f"SELECT c.id, c.role, c.content, c.createdAt, c.feedback FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
+        return [item async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, max_item_count=-1)]
 
@@ -1,16 +1,32 @@
 import os
+import re
+import time
 import json
+import hashlib
 import logging
-import requests
+import httpx
+import orjson
 import dataclasses
 
-# Check for a DEBUG environment variable to set the logging level.
-DEBUG = os.environ.get("DEBUG", "false")
-if DEBUG.lower() == "true":
-    logging.basicConfig(level=logging.DEBUG)  # Set logging level to DEBUG if environment variable is true.
-
 # Retrieve the Azure Search column name for filtering based on user's groups.
 AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
+# The column never changes after startup, so build the static parts of the group filter once.
+_FILTER_PREFIX = f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '"
+_FILTER_SUFFIX = "'))"
+
+# Separator for multi-column settings, which may use "|", "," or both.
+_COLUMN_SEPARATOR = re.compile(r"[|,]")
+
+# Group membership rarely changes, so cache each user's groups for a few minutes.
+USER_GROUPS_CACHE_TTL = 300
+USER_GROUPS_CACHE_MAXSIZE = 10000
+_user_groups_cache = {}
+
+def init_logging():
+    # Configure logging once at app startup rather than as an import side effect.
+    # Check for a DEBUG environment variable to set the logging level.
+    if os.environ.get("DEBUG", "false").lower() == "true":
+        logging.basicConfig(level=logging.DEBUG)  # Set logging level to DEBUG if environment variable is true.
 
 class JSONEncoder(json.JSONEncoder):
     # Custom JSON encoder for encoding dataclasses to JSON.
@@ -21,64 +37,121 @@ class JSONEncoder(json.JSONEncoder):
         # Fallback to the default encoder for other types.
         return super().default(o)
 
+# Shared compact encoder, so callers don't construct a JSONEncoder per call.
+_ENCODER = JSONEncoder(separators=(",", ":"))
+
+# Serialization options for each streamed NDJSON line, combined once at import.
+_NDJSON_OPTIONS = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+
+# Any non-ASCII character in orjson output is inside a JSON string, so it can be escaped in place.
+_NON_ASCII = re.compile(r"[^\x00-\x7f]")
+
+def _escape_non_ascii(match):
+    # Escape a code point as \uXXXX, using a surrogate pair above U+FFFF as json.dumps does.
+    code = ord(match.group())
+    if code > 0xFFFF:
+        code -= 0x10000
+        return "\\u%04x\\u%04x" % (0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+    return "\\u%04x" % code
+
+def _dumps_ascii(obj, option=None):
+    # Serialize with orjson and escape any non-ASCII characters, keeping the stream pure ASCII.
+    # The shipped frontend decodes each network read on its own, so a multi-byte character
+    # split across two reads would be garbled.
+    data = orjson.dumps(obj, option=option)
+    if data.isascii():
+        return data
+    return _NON_ASCII.sub(_escape_non_ascii, data.decode("utf-8")).encode("ascii")
+
 async def format_as_ndjson(r):
     # Asynchronously format data as Newline Delimited JSON (NDJSON).
     try:
         async for event in r:
-            # Serialize each event to JSON and append a newline.
-            yield json.dumps(event, cls=JSONEncoder) + "\n"
+            # Serialize each event to ASCII JSON bytes with a trailing newline.
+            yield _dumps_ascii(event, option=_NDJSON_OPTIONS)
     except Exception as error:
         # Log exceptions during serialization.
         logging.exception("Exception while generating response stream: %s", error)
         # Yield an error message in JSON format.
-        yield json.dumps({"error": str(error)})
+        yield _dumps_ascii({"error": str(error)})
 
 def parse_multi_columns(columns: str) -> list:
     # Split a string of columns separated by "|" or "," into a list.
-    if "|" in columns:
-        return columns.split("|")
-    else:
-        return columns.split(",")
-
-def fetchUserGroups(userToken, nextLink=None):
-    # Fetch user's group memberships from Microsoft Graph API, supporting pagination.
-    if nextLink:
-        endpoint = nextLink  # Use the nextLink URL if provided for pagination.
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+    return _COLUMN_SEPARATOR.split(columns)
+
+_graph_client = None
+
+def get_graph_client():
+    # Reuse a single HTTP/2 client, and its connection, for all Microsoft Graph requests.
+    global _graph_client
+    if _graph_client is None or _graph_client.is_closed:
+        _graph_client = httpx.AsyncClient(http2=True, timeout=5.0)
+    return _graph_client
+
+async def close_graph_client():
+    # Close the shared Microsoft Graph client when the app stops serving.
+    global _graph_client
+    if _graph_client is not None:
+        await _graph_client.aclose()
+        _graph_client = None
+
+async def fetchUserGroups(userToken, nextLink=None):
+    # Fetch user's group memberships from Microsoft Graph API, following pagination links.
+    # Returns None if any page fails, so a partial list is never mistaken for the full membership.
+    endpoint = nextLink or "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
     
     headers = {
         'Authorization': "bearer " + userToken  # Use the provided user token for authentication.
     }
+    userGroups = []
     try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            # Log an error if the request failed.
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
-        
-        r = r.json()
-        if "@odata.nextLink" in r:
-            # Recursively fetch additional pages of groups if a nextLink is present.
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r['value'].extend(nextLinkData)
-        
-        return r['value']  # Return the list of user groups.
+        while endpoint:
+            r = await get_graph_client().get(endpoint, headers=headers)
+            if r.status_code != 200:
+                # Log an error if the request failed.
+                logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
+                return None
+
+            r = r.json()
+            userGroups.extend(r.get('value', []))
+            endpoint = r.get("@odata.nextLink")  # Continue with the next page, if any.
     except Exception as e:
         # Log any exceptions that occur.
         logging.error(f"Exception in fetchUserGroups: {e}")
+        return None
+
+    return userGroups  # Return the complete list of user groups.
+
+async def getUserGroups(userToken):
+    # Return the user's groups from the in-process cache, fetching them from Microsoft Graph on a miss.
+    key = hashlib.blake2b(userToken.encode(), digest_size=16).digest()  # Avoid keeping raw tokens in memory.
+    now = time.monotonic()
+    cached = _user_groups_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    userGroups = await fetchUserGroups(userToken)
+    if userGroups is None:
+        # Don't cache failed lookups; the next request will try Graph again.
         return []
 
-def generateFilterString(userToken):
+    # Entries are kept in insertion order, so the first one is always the closest to expiry.
+    _user_groups_cache.pop(key, None)
+    while len(_user_groups_cache) >= USER_GROUPS_CACHE_MAXSIZE:
+        del _user_groups_cache[next(iter(_user_groups_cache))]
+    _user_groups_cache[key] = (now + USER_GROUPS_CACHE_TTL, userGroups)
+
+    return userGroups
+
+async def generateFilterString(userToken):
     # Generate a filter string for Azure Search queries based on user group membership.
-    userGroups = fetchUserGroups(userToken)  # Fetch user's groups.
+    userGroups = await getUserGroups(userToken)  # Fetch user's groups.
 
     if not userGroups:
         logging.debug("No user groups found")
 
     # Create a filter string using the group IDs.
-    group_ids = ", ".join([obj['id'] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+    return _FILTER_PREFIX + ", ".join(obj['id'] for obj in userGroups) + _FILTER_SUFFIX
 
 def format_non_streaming_response(chatCompletion, history_metadata, message_uuid=None):
     # Format a response for non-streaming content.
@@ -94,19 +167,21 @@ def format_non_streaming_response(chatCompletion, history_metadata, message_uuid
     if len(chatCompletion.choices) > 0:
         message = chatCompletion.choices[0].message
         if message:
-            if hasattr(message, "context") and message.context.get("messages"):
-                for m in message.context["messages"]:
+            context = getattr(message, "context", None)  # Look up the context once.
+            messages = response_obj["choices"][0]["messages"]
+            if context is not None and context.get("messages"):
+                for m in context["messages"]:
                     if m["role"] == "tool":
-                        response_obj["choices"][0]["messages"].append({
+                        messages.append({
                             "role": "tool",
                             "content": m["content"]
                         })
-            elif hasattr(message, "context"):
-                response_obj["choices"][0]["messages"].append({
+            elif context is not None:
+                messages.append({
                     "role": "tool",
-                    "content": json.dumps(message.context),
+                    "content": _ENCODER.encode(context),
                 })
-            response_obj["choices"][0]["messages"].append({
+            messages.append({
                 "role": "assistant",
                 "content": message.content,
             })
@@ -128,21 +203,23 @@ def format_stream_response(chatCompletionChunk, history_metadata, message_uuid=N
     if len(chatCompletionChunk.choices) > 0:
         delta = chatCompletionChunk.choices[0].delta
         if delta:
-            if hasattr(delta, "context") and delta.context.get("messages"):
-                for m in delta.context["messages"]:
+            context = getattr(delta, "context", None)  # Look up the context once per chunk.
+            messages = response_obj["choices"][0]["messages"]
+            if context is not None and context.get("messages"):
+                for m in context["messages"]:
                     if m["role"] == "tool":
                         messageObj = {
                             "role": "tool",
                             "content": m["content"]
                         }
-                        response_obj["choices"][0]["messages"].append(messageObj)
+                        messages.append(messageObj)
                         return response_obj  # Return the response for this chunk of streaming content.
-            if delta.role == "assistant" and hasattr(delta, "context"):
+            if delta.role == "assistant" and context is not None:
                 messageObj = {
                     "role": "assistant",
-                    "context": delta.context,
+                    "context": context,
                 }
-                response_obj["choices"][0]["messages"].append(messageObj)
+                messages.append(messageObj)
                 return response_obj
             else:
                 if delta.content:
@@ -150,7 +227,7 @@ def format_stream_response(chatCompletionChunk, history_metadata, message_uuid=N
                         "role": "assistant",
                         "content": delta.content,
                     }
-                    response_obj["choices"][0]["messages"].append(messageObj)
+                    messages.append(messageObj)
                     return response_obj
     
     return {}  # Return an empty object if no content is available.
@@ -192,13 +192,14 @@ const Chat = () => {
             if (response?.body) {
                 const reader = response.body.getReader();
 
+                const decoder = new TextDecoder("utf-8");
                 let runningText = "";
                 while (true) {
                     setProcessMessages(messageStatus.Processing)
                     const { done, value } = await reader.read();
                     if (done) break;
 
-                    var text = new TextDecoder("utf-8").decode(value);
+                    var text = decoder.decode(value, { stream: true });
                     const objects = text.split("\n");
                     objects.forEach((obj) => {
                         try {
@@ -340,13 +341,14 @@ const Chat = () => {
             if (response?.body) {
                 const reader = response.body.getReader();
 
+                const decoder = new TextDecoder("utf-8");
                 let runningText = "";
                 while (true) {
                     setProcessMessages(messageStatus.Processing)
                     const { done, value } = await reader.read();
                     if (done) break;
 
-                    var text = new TextDecoder("utf-8").decode(value);
+                    var text = decoder.decode(value, { stream: true });
                     const objects = text.split("\n");
                     objects.forEach((obj) => {
                         try {
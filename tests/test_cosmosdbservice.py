@@ -0,0 +1,89 @@
+import pytest
+from azure.cosmos import exceptions
+from backend.history.cosmosdbservice import CosmosConversationClient
+
+
+class DummyContainerClient:
+    def __init__(self, failing_ids):
+        self.failing_ids = failing_ids
+        self.deleted = []
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        raise exceptions.CosmosBatchOperationError(error_index=0, headers={}, status_code=404, message="batch failed", operation_responses=[])
+
+    async def delete_item(self, item, partition_key):
+        if item in self.failing_ids:
+            raise self.failing_ids[item]
+        self.deleted.append(item)
+        return {}
+
+
+def dummy_conversation_client(container_client, message_ids):
+    client = CosmosConversationClient.__new__(CosmosConversationClient)
+    client.container_client = container_client
+
+    async def get_messages(user_id, conversation_id):
+        return [{"id": message_id} for message_id in message_ids]
+
+    client.get_messages = get_messages
+    return client
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_fallback_ignores_missing_messages():
+    container_client = DummyContainerClient({"msg1": exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")})
+    client = dummy_conversation_client(container_client, ["msg1", "msg2"])
+
+    assert await client.delete_messages("conversation", "user") == [{}]
+    assert container_client.deleted == ["msg2"]
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_fallback_raises_other_errors():
+    container_client = DummyContainerClient({"msg1": exceptions.CosmosHttpResponseError(status_code=429, message="throttled")})
+    client = dummy_conversation_client(container_client, ["msg1", "msg2"])
+
+    with pytest.raises(exceptions.CosmosHttpResponseError):
+        await client.delete_messages("conversation", "user")
+
+
+@pytest.mark.asyncio
+async def test_create_message_requires_conversation_document():
+    class PatchContainerClient:
+        async def upsert_item(self, body, no_response=None):
+            return {}
+
+        async def patch_item(self, item, partition_key, patch_operations, filter_predicate=None, no_response=None):
+            assert filter_predicate == "FROM c WHERE c.type = 'conversation'"
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="precondition failed")
+
+    client = dummy_conversation_client(PatchContainerClient(), [])
+    client.enable_message_feedback = False
+    message = {"role": "user", "content": "hello"}
+
+    assert await client.create_message("msg1", "not-a-conversation", "user", message) == "Conversation not found"
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_in_batches():
+    class BatchContainerClient:
+        def __init__(self):
+            self.batches = []
+
+        async def execute_item_batch(self, batch_operations, partition_key):
+            self.batches.append((batch_operations, partition_key))
+            return [{"statusCode": 204}] * len(batch_operations)
+
+        async def delete_item(self, item, partition_key):
+            raise AssertionError("delete_item should not be called when the batch succeeds")
+
+    container_client = BatchContainerClient()
+    message_ids = [f"msg{i}" for i in range(150)]
+    client = dummy_conversation_client(container_client, message_ids)
+
+    response_list = await client.delete_messages("conversation", "user")
+
+    assert [len(operations) for operations, _ in container_client.batches] == [100, 50]
+    assert all(partition_key == "user" for _, partition_key in container_client.batches)
+    assert [operation for operations, _ in container_client.batches for operation in operations] == [("delete", (message_id,)) for message_id in message_ids]
+    assert response_list == [[{"statusCode": 204}] * 100, [{"statusCode": 204}] * 50]
@@ -1,5 +1,9 @@
+import json
+import httpx
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from types import SimpleNamespace
+import backend.utils
+from backend.utils import format_as_ndjson, parse_multi_columns, fetchUserGroups, getUserGroups, generateFilterString, format_non_streaming_response, format_stream_response
 
 
 @pytest.mark.asyncio
@@ -8,7 +12,7 @@ async def test_format_as_ndjson():
         yield {"message": "test message\n"}
 
     async for event in format_as_ndjson(dummy_generator()):
-        assert event == '{"message": "test message\\n"}\n'
+        assert event == b'{"message":"test message\\n"}\n'
 
 
 @pytest.mark.asyncio
@@ -18,7 +22,16 @@ async def test_format_as_ndjson_exception():
         yield {"message": "test message\n"}
     
     async for event in format_as_ndjson(dummy_generator()):
-        assert event == '{"error": "test exception"}'
+        assert event == b'{"error":"test exception"}'
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_non_ascii():
+    async def dummy_generator():
+        yield {"message": "café ✓ 😀"}
+
+    async for event in format_as_ndjson(dummy_generator()):
+        assert event == b'{"message":"caf\\u00e9 \\u2713 \\ud83d\\ude00"}\n'
+        assert json.loads(event) == {"message": "café ✓ 😀"}
 
 def test_parse_multi_columns():
     test_pipes = "col1|col2|col3"
@@ -27,3 +40,89 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+    assert parse_multi_columns("col1|col2,col3") == ["col1", "col2", "col3"]
+
+@pytest.mark.asyncio
+async def test_fetch_user_groups_paginated(monkeypatch):
+    pages = {
+        "/v1.0/me/transitiveMemberOf": {"value": [{"id": "group1"}], "@odata.nextLink": "https://graph.microsoft.com/v1.0/page2"},
+        "/v1.0/page2": {"value": [{"id": "group2"}]}
+    }
+    def handler(request):
+        assert request.headers["Authorization"] == "bearer token"
+        return httpx.Response(200, json=pages[request.url.path])
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        monkeypatch.setattr(backend.utils, "_graph_client", client)
+        assert await fetchUserGroups("token") == [{"id": "group1"}, {"id": "group2"}]
+
+@pytest.mark.asyncio
+async def test_get_user_groups_not_cached_on_partial_failure(monkeypatch):
+    pages = {
+        "/v1.0/me/transitiveMemberOf": httpx.Response(200, json={"value": [{"id": "group1"}], "@odata.nextLink": "https://graph.microsoft.com/v1.0/page2"}),
+        "/v1.0/page2": httpx.Response(429, text="throttled")
+    }
+    def handler(request):
+        return pages[request.url.path]
+
+    cache = {}
+    monkeypatch.setattr(backend.utils, "_user_groups_cache", cache)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        monkeypatch.setattr(backend.utils, "_graph_client", client)
+        assert await fetchUserGroups("token") is None
+        assert await getUserGroups("token") == []
+    assert cache == {}
+
+@pytest.mark.asyncio
+async def test_get_user_groups_cached(monkeypatch):
+    calls = []
+    async def dummy_fetch(userToken, nextLink=None):
+        calls.append(userToken)
+        return [{"id": "group1"}]
+
+    monkeypatch.setattr(backend.utils, "fetchUserGroups", dummy_fetch)
+    monkeypatch.setattr(backend.utils, "_user_groups_cache", {})
+    assert await getUserGroups("token1") == [{"id": "group1"}]
+    assert await getUserGroups("token1") == [{"id": "group1"}]
+    assert await getUserGroups("token2") == [{"id": "group1"}]
+    assert calls == ["token1", "token2"]
+
+@pytest.mark.asyncio
+async def test_generate_filter_string(monkeypatch):
+    async def dummy_get_user_groups(userToken):
+        return [{"id": "group1"}, {"id": "group2"}]
+
+    monkeypatch.setattr(backend.utils, "getUserGroups", dummy_get_user_groups)
+    column = backend.utils.AZURE_SEARCH_PERMITTED_GROUPS_COLUMN
+    assert await generateFilterString("token") == f"{column}/any(g:search.in(g, 'group1, group2'))"
+
+def test_format_non_streaming_response():
+    message = SimpleNamespace(content="answer", context={"messages": [{"role": "tool", "content": "citations"}]})
+    completion = SimpleNamespace(id="id", model="model", created=0, object="chat.completion", choices=[SimpleNamespace(message=message)])
+    response = format_non_streaming_response(completion, {})
+    assert response["choices"][0]["messages"] == [
+        {"role": "tool", "content": "citations"},
+        {"role": "assistant", "content": "answer"}
+    ]
+
+def test_format_non_streaming_response_without_context_messages():
+    message = SimpleNamespace(content="answer", context={"intent": "question"})
+    completion = SimpleNamespace(id="id", model="model", created=0, object="chat.completion", choices=[SimpleNamespace(message=message)])
+    response = format_non_streaming_response(completion, {})
+    assert response["choices"][0]["messages"] == [
+        {"role": "tool", "content": '{"intent":"question"}'},
+        {"role": "assistant", "content": "answer"}
+    ]
+
+def test_format_stream_response():
+    def chunk(delta):
+        return SimpleNamespace(id="id", model="model", created=0, object="chat.completion.chunk", choices=[SimpleNamespace(delta=delta)])
+
+    tool_delta = SimpleNamespace(role="assistant", content=None, context={"messages": [{"role": "tool", "content": "citations"}]})
+    assert format_stream_response(chunk(tool_delta), {})["choices"][0]["messages"] == [{"role": "tool", "content": "citations"}]
+
+    content_delta = SimpleNamespace(role=None, content="answer")
+    assert format_stream_response(chunk(content_delta), {})["choices"][0]["messages"] == [{"role": "assistant", "content": "answer"}]
+
+    empty_delta = SimpleNamespace(role=None, content=None)
+    assert format_stream_response(chunk(empty_delta), {}) == {}